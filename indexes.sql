@@ -0,0 +1,14 @@
+-- Indexes for the online_retail table in SQLite
+-- Created by load_data.py after the bulk load so inserts do not maintain them row by row
+
+CREATE INDEX IF NOT EXISTS idx_online_retail_invoicedate
+    ON online_retail (InvoiceDate);
+
+CREATE INDEX IF NOT EXISTS idx_online_retail_customer
+    ON online_retail (CustomerID);
+
+CREATE INDEX IF NOT EXISTS idx_online_retail_country
+    ON online_retail (Country);
+
+-- Refresh planner statistics so queries can choose between the indexes above
+ANALYZE;
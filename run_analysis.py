@@ -8,12 +8,25 @@ import os
 import sqlite3
 from pathlib import Path
 
+import numpy as np
 import pandas as pd
 
 
 DB_PATH = "online_retail.db"
 OUTPUT_DIR = Path("outputs")
 
+# RFM score boundaries: recency is scored down as days grow, frequency and monetary up
+RECENCY_DAYS = [30, 60, 90, 180]
+FREQUENCY_ORDERS = [5, 10, 20, 50]
+MONETARY_VALUES = [500, 1000, 2000, 5000]
+
+# Upper bounds of the 1 / 2-5 / 6-10 / 11-20 / 21-50 / 50+ count buckets
+COUNT_BUCKET_BOUNDS = [1, 5, 10, 20, 50]
+PURCHASE_FREQUENCY_LABELS = [
+    "1 purchase", "2-5 purchases", "6-10 purchases", "11-20 purchases", "21-50 purchases", "50+ purchases",
+]
+BASKET_SIZE_LABELS = ["1 item", "2-5 items", "6-10 items", "11-20 items", "21-50 items", "50+ items"]
+
 
 def run_query(conn, query: str, description: str = ""):
     """Run a single SQL query and return a DataFrame (if it returns rows)."""
@@ -30,6 +43,178 @@ def run_query(conn, query: str, description: str = ""):
         return None
 
 
+def create_base_table(conn) -> None:
+    """Materialize the priced transaction lines and per-invoice and per-product totals for the reports to share."""
+    conn.executescript(
+        """
+        DROP TABLE IF EXISTS temp.base;
+
+        CREATE TEMP TABLE base AS
+        SELECT
+            InvoiceNo,
+            StockCode,
+            Description,
+            CustomerID,
+            Country,
+            InvoiceDate,
+            Quantity,
+            UnitPrice,
+            Quantity * UnitPrice AS line_total,
+            CASE WHEN Quantity > 0 THEN Quantity * UnitPrice ELSE 0 END AS sales_amt,
+            CASE WHEN Quantity < 0 THEN ABS(Quantity * UnitPrice) ELSE 0 END AS return_amt,
+            strftime('%Y-%m', InvoiceDate) AS year_month,
+            CAST(strftime('%H', InvoiceDate) AS INTEGER) AS hour_of_day,
+            CAST(strftime('%w', InvoiceDate) AS INTEGER) AS weekday,
+            is_cancel
+        FROM online_retail
+        WHERE UnitPrice IS NOT NULL;
+
+        -- One row per non-cancelled invoice, so per-group invoice counts need no DISTINCT
+        DROP TABLE IF EXISTS temp.invoice_summary;
+
+        CREATE TEMP TABLE invoice_summary AS
+        SELECT
+            InvoiceNo,
+            CustomerID,
+            Country,
+            SUM(sales_amt) AS invoice_revenue,
+            SUM(CASE WHEN Quantity > 0 THEN Quantity ELSE 0 END) AS invoice_qty,
+            COUNT(*) AS line_count,
+            MIN(InvoiceDate) AS first_date,
+            MAX(InvoiceDate) AS last_date,
+            MIN(year_month) AS year_month
+        FROM base
+        WHERE is_cancel = 0
+        GROUP BY InvoiceNo, CustomerID, Country;
+
+        -- One row per product, shared by the three top-product reports
+        DROP TABLE IF EXISTS temp.product_summary;
+
+        CREATE TEMP TABLE product_summary AS
+        SELECT
+            StockCode,
+            COALESCE(Description, 'No Description') AS Description,
+            ROUND(SUM(sales_amt), 2) AS product_revenue,
+            SUM(CASE WHEN Quantity > 0 THEN Quantity ELSE 0 END) AS total_quantity_sold,
+            SUM(CASE WHEN Quantity < 0 THEN ABS(Quantity) ELSE 0 END) AS total_returned,
+            COUNT(DISTINCT InvoiceNo) AS times_purchased,
+            COUNT(DISTINCT CustomerID) AS unique_customers,
+            ROUND(AVG(UnitPrice), 2) AS avg_unit_price
+        FROM base
+        WHERE is_cancel = 0
+        GROUP BY StockCode, Description;
+        """
+    )
+
+
+def create_sales_table(conn) -> None:
+    """Materialize the customer sales lines (non-cancelled, positive quantity) used by the cohort analysis."""
+    conn.executescript(
+        """
+        DROP TABLE IF EXISTS temp.sales;
+
+        -- Unpriced lines are kept so first purchases match the full history;
+        -- revenue queries filter them with UnitPrice IS NOT NULL
+        CREATE TEMP TABLE sales AS
+        SELECT
+            InvoiceNo,
+            CustomerID,
+            StockCode,
+            Country,
+            InvoiceDate,
+            strftime('%Y-%m', InvoiceDate) AS order_month,
+            Quantity,
+            UnitPrice,
+            Quantity * UnitPrice AS line_revenue
+        FROM online_retail
+        WHERE CustomerID IS NOT NULL AND is_cancel = 0 AND Quantity > 0;
+
+        CREATE INDEX temp.idx_sales_customer ON sales (CustomerID);
+        """
+    )
+
+
+def rfm_segment(recency: int, frequency: int, monetary: int) -> str:
+    """Map a customer's R, F and M scores to a segment name."""
+    if recency >= 4 and frequency >= 4 and monetary >= 4:
+        return "Champions"
+    if recency >= 3 and frequency >= 4 and monetary >= 3:
+        return "Loyal Customers"
+    if recency >= 4 and frequency <= 2:
+        return "Potential Loyalists"
+    if recency >= 3 and frequency <= 2 and monetary >= 3:
+        return "At Risk"
+    if recency <= 2 and frequency >= 3:
+        return "Cannot Lose Them"
+    if recency <= 2 and frequency <= 2 and monetary >= 3:
+        return "Hibernating"
+    if recency <= 2:
+        return "Lost"
+    return "Need Attention"
+
+
+# Segment lookup indexed by (recency_score, frequency_score, monetary_score)
+RFM_SEGMENTS = np.empty((6, 6, 6), dtype=object)
+for _r in range(1, 6):
+    for _f in range(1, 6):
+        for _m in range(1, 6):
+            RFM_SEGMENTS[_r, _f, _m] = rfm_segment(_r, _f, _m)
+
+
+def score_rfm(metrics):
+    """Add R, F, M scores and segments to per-customer metrics, best customers first."""
+    if metrics is None:
+        return None
+    days = metrics["days_since_last_purchase"].to_numpy(dtype=float)
+    recency = 5 - np.searchsorted(RECENCY_DAYS, days, side="left")
+    frequency = 1 + np.searchsorted(FREQUENCY_ORDERS, metrics["frequency"].to_numpy(), side="right")
+    monetary = 1 + np.searchsorted(
+        MONETARY_VALUES, metrics["monetary_value"].to_numpy(dtype=float), side="right"
+    )
+    rfm = metrics.assign(
+        recency_score=recency,
+        frequency_score=frequency,
+        monetary_score=monetary,
+        rfm_score=recency + frequency + monetary,
+        customer_segment=RFM_SEGMENTS[recency, frequency, monetary],
+    )
+    return rfm.sort_values(
+        ["rfm_score", "monetary_value"], ascending=False, kind="stable", ignore_index=True
+    )
+
+
+def sql_round(values, decimals: int = 2):
+    """Round like SQLite's ROUND, with halves away from zero (pandas rounds half to even)."""
+    scale = 10.0 ** decimals
+    return np.sign(values) * np.floor(np.abs(values) * scale + 0.5) / scale
+
+
+def summarize_rfm(rfm):
+    """Customer count, revenue share and average value per RFM segment."""
+    if rfm is None:
+        return None
+    grouped = rfm.groupby("customer_segment")["monetary_value"]
+    summary = pd.DataFrame({
+        "num_customers": grouped.size(),
+        "percentage": sql_round(100.0 * grouped.size() / len(rfm)),
+        "total_revenue": sql_round(grouped.sum()),
+        "avg_customer_value": sql_round(grouped.mean()),
+    })
+    return summary.reset_index().sort_values("total_revenue", ascending=False, ignore_index=True)
+
+
+def bucket_distribution(values, labels, category_column: str, count_column: str, total: int):
+    """Count values per COUNT_BUCKET_BOUNDS bucket, with each bucket's share of total."""
+    codes = np.searchsorted(COUNT_BUCKET_BOUNDS, values, side="left")
+    counts = np.bincount(codes, minlength=len(labels))
+    present = counts > 0
+    return pd.DataFrame({
+        category_column: np.asarray(labels)[present],
+        count_column: counts[present],
+        "percentage": sql_round(100.0 * counts[present] / total),
+    })
+
+
 def save_to_csv(df, filename: str, output_dir: Path = OUTPUT_DIR):
     """Save DataFrame to CSV file."""
     if df is not None and not df.empty:
@@ -51,8 +236,24 @@ def main():
     print("=" * 70)
 
     with sqlite3.connect(DB_PATH) as conn:
+        # Databases loaded before is_cancel was added to schema.sql lack the column
+        try:
+            conn.execute("SELECT is_cancel FROM online_retail LIMIT 0")
+        except sqlite3.OperationalError as exc:
+            raise RuntimeError(
+                f"Database '{DB_PATH}' uses an older schema ({exc}). "
+                "Re-run `python load_data.py` to rebuild it."
+            ) from exc
         print("\n✓ Connected to database.")
 
+        # Read-side settings: keep temp tables and sorts in memory with a 256MB page cache
+        conn.execute("PRAGMA temp_store = MEMORY")
+        conn.execute("PRAGMA cache_size = -262144")
+        conn.execute("PRAGMA mmap_size = 1073741824")
+
+        # Shared base table: one scan of online_retail instead of one per report
+        create_base_table(conn)
+
         # ====================================================================
         # SECTION 1: BASIC STATISTICS
         # ====================================================================
@@ -60,44 +261,58 @@ def main():
         print("SECTION 1: BASIC STATISTICS & DATA OVERVIEW")
         print("=" * 70)
 
-        # 1.1 Total row count
-        total_rows = run_query(
+        # Sections 1 and 2 are sliced from two single-pass summaries: one over all
+        # rows of online_retail and one over the priced lines in base
+        overview = run_query(
             conn,
-            "SELECT COUNT(*) AS total_rows FROM online_retail;",
-            "=== Total Rows ==="
+            """
+            SELECT
+                COUNT(*) AS total_rows,
+                COUNT(DISTINCT InvoiceNo) AS total_invoices,
+                COUNT(DISTINCT CASE WHEN is_cancel = 0 THEN InvoiceNo END) AS valid_invoices,
+                COUNT(DISTINCT CASE WHEN is_cancel = 1 THEN InvoiceNo END) AS cancelled_invoices,
+                COUNT(DISTINCT CustomerID) AS total_customers,
+                COUNT(DISTINCT StockCode) AS total_products,
+                COUNT(DISTINCT Country) AS total_countries,
+                SUM(CASE WHEN CustomerID IS NULL THEN 1 ELSE 0 END) AS missing_customer_id,
+                ROUND(100.0 * SUM(CASE WHEN CustomerID IS NULL THEN 1 ELSE 0 END) / COUNT(*), 2) AS pct_missing_customer_id,
+                SUM(CASE WHEN Description IS NULL OR Description = '' THEN 1 ELSE 0 END) AS missing_description,
+                ROUND(100.0 * COUNT(DISTINCT CASE WHEN is_cancel = 1 THEN InvoiceNo END) / 
+                      COUNT(DISTINCT InvoiceNo), 2) AS cancellation_rate_pct
+            FROM online_retail;
+            """
         )
-        print(total_rows)
-
-        # 1.2 Total revenue breakdown
-        revenue_breakdown = run_query(
+        line_totals = run_query(
             conn,
             """
             SELECT
-                ROUND(SUM(Quantity * UnitPrice), 2) AS total_revenue,
-                ROUND(SUM(CASE WHEN Quantity > 0 THEN Quantity * UnitPrice ELSE 0 END), 2) AS sales_revenue,
-                ROUND(SUM(CASE WHEN Quantity < 0 THEN ABS(Quantity * UnitPrice) ELSE 0 END), 2) AS return_value
-            FROM online_retail
-            WHERE UnitPrice IS NOT NULL;
-            """,
-            "=== Revenue Breakdown ==="
+                ROUND(SUM(line_total), 2) AS total_revenue,
+                ROUND(SUM(sales_amt), 2) AS sales_revenue,
+                ROUND(SUM(return_amt), 2) AS return_value,
+                COUNT(CASE WHEN Quantity < 0 THEN 1 END) AS return_transactions,
+                SUM(CASE WHEN Quantity < 0 THEN Quantity END) AS total_returned_quantity,
+                ROUND(SUM(CASE WHEN Quantity < 0 THEN line_total END), 2) AS net_return_value,
+                COUNT(DISTINCT CASE WHEN Quantity < 0 THEN InvoiceNo END) AS return_invoices
+            FROM base;
+            """
         )
+
+        # 1.1 Total row count
+        total_rows = overview[["total_rows"]]
+        print("\n=== Total Rows ===")
+        print(total_rows)
+
+        # 1.2 Total revenue breakdown
+        revenue_breakdown = line_totals[["total_revenue", "sales_revenue", "return_value"]]
+        print("\n=== Revenue Breakdown ===")
         print(revenue_breakdown)
 
         # 1.3 Distinct counts
-        distinct_counts = run_query(
-            conn,
-            """
-            SELECT 
-                COUNT(DISTINCT InvoiceNo) AS total_invoices,
-                COUNT(DISTINCT CASE WHEN InvoiceNo NOT LIKE 'C%' THEN InvoiceNo END) AS valid_invoices,
-                COUNT(DISTINCT CASE WHEN InvoiceNo LIKE 'C%' THEN InvoiceNo END) AS cancelled_invoices,
-                COUNT(DISTINCT CustomerID) AS total_customers,
-                COUNT(DISTINCT StockCode) AS total_products,
-                COUNT(DISTINCT Country) AS total_countries
-            FROM online_retail;
-            """,
-            "=== Distinct Counts ==="
-        )
+        distinct_counts = overview[[
+            "total_invoices", "valid_invoices", "cancelled_invoices",
+            "total_customers", "total_products", "total_countries",
+        ]]
+        print("\n=== Distinct Counts ===")
         print(distinct_counts)
 
         # ====================================================================
@@ -108,50 +323,23 @@ def main():
         print("=" * 70)
 
         # 2.1 Missing values analysis
-        missing_values = run_query(
-            conn,
-            """
-            SELECT 
-                COUNT(*) AS total_rows,
-                SUM(CASE WHEN CustomerID IS NULL THEN 1 ELSE 0 END) AS missing_customer_id,
-                ROUND(100.0 * SUM(CASE WHEN CustomerID IS NULL THEN 1 ELSE 0 END) / COUNT(*), 2) AS pct_missing_customer_id,
-                SUM(CASE WHEN Description IS NULL OR Description = '' THEN 1 ELSE 0 END) AS missing_description
-            FROM online_retail;
-            """,
-            "=== Missing Values Analysis ==="
-        )
+        missing_values = overview[[
+            "total_rows", "missing_customer_id", "pct_missing_customer_id", "missing_description",
+        ]]
+        print("\n=== Missing Values Analysis ===")
         print(missing_values)
         save_to_csv(missing_values, "data_quality_report.csv")
 
         # 2.2 Cancellation analysis
-        cancellation_analysis = run_query(
-            conn,
-            """
-            SELECT 
-                COUNT(DISTINCT CASE WHEN InvoiceNo LIKE 'C%' THEN InvoiceNo END) AS cancelled_invoices,
-                COUNT(DISTINCT InvoiceNo) AS total_invoices,
-                ROUND(100.0 * COUNT(DISTINCT CASE WHEN InvoiceNo LIKE 'C%' THEN InvoiceNo END) / 
-                      COUNT(DISTINCT InvoiceNo), 2) AS cancellation_rate_pct
-            FROM online_retail;
-            """,
-            "=== Cancellation Analysis ==="
-        )
+        cancellation_analysis = overview[["cancelled_invoices", "total_invoices", "cancellation_rate_pct"]]
+        print("\n=== Cancellation Analysis ===")
         print(cancellation_analysis)
 
         # 2.3 Returns analysis
-        returns_analysis = run_query(
-            conn,
-            """
-            SELECT 
-                COUNT(*) AS return_transactions,
-                SUM(Quantity) AS total_returned_quantity,
-                ROUND(SUM(Quantity * UnitPrice), 2) AS return_value,
-                COUNT(DISTINCT InvoiceNo) AS return_invoices
-            FROM online_retail
-            WHERE Quantity < 0 AND UnitPrice IS NOT NULL;
-            """,
-            "=== Returns Analysis ==="
-        )
+        returns_analysis = line_totals[[
+            "return_transactions", "total_returned_quantity", "net_return_value", "return_invoices",
+        ]].rename(columns={"net_return_value": "return_value"})
+        print("\n=== Returns Analysis ===")
         print(returns_analysis)
 
         # ====================================================================
@@ -167,13 +355,12 @@ def main():
             """
             SELECT
                 Country,
-                ROUND(SUM(CASE WHEN Quantity > 0 THEN Quantity * UnitPrice ELSE 0 END), 2) AS sales_revenue,
-                COUNT(DISTINCT InvoiceNo) AS num_invoices,
+                ROUND(SUM(invoice_revenue), 2) AS sales_revenue,
+                COUNT(*) AS num_invoices,
                 COUNT(DISTINCT CustomerID) AS num_customers,
-                ROUND(SUM(CASE WHEN Quantity > 0 THEN Quantity * UnitPrice ELSE 0 END) / 
-                      NULLIF(COUNT(DISTINCT InvoiceNo), 0), 2) AS avg_order_value
-            FROM online_retail
-            WHERE UnitPrice IS NOT NULL AND InvoiceNo NOT LIKE 'C%'
+                ROUND(ROUND(SUM(invoice_revenue), 2) /
+                      NULLIF(COUNT(*), 0), 2) AS avg_order_value
+            FROM invoice_summary
             GROUP BY Country
             ORDER BY sales_revenue DESC
             LIMIT 20;
@@ -188,12 +375,12 @@ def main():
             conn,
             """
             SELECT
-                strftime('%Y-%m', InvoiceDate) AS year_month,
-                ROUND(SUM(CASE WHEN Quantity > 0 THEN Quantity * UnitPrice ELSE 0 END), 2) AS sales_revenue,
-                COUNT(DISTINCT InvoiceNo) AS num_invoices,
+                year_month,
+                ROUND(SUM(invoice_revenue), 2) AS sales_revenue,
+                COUNT(*) AS num_invoices,
                 COUNT(DISTINCT CustomerID) AS num_customers
-            FROM online_retail
-            WHERE InvoiceDate IS NOT NULL AND UnitPrice IS NOT NULL AND InvoiceNo NOT LIKE 'C%'
+            FROM invoice_summary
+            WHERE first_date IS NOT NULL
             GROUP BY year_month
             ORDER BY year_month;
             """,
@@ -202,30 +389,17 @@ def main():
         print(monthly_trend)
         save_to_csv(monthly_trend, "monthly_revenue_trend.csv")
 
-        # 3.3 Revenue growth rate
-        revenue_growth = run_query(
-            conn,
-            """
-            WITH monthly_revenue AS (
-                SELECT
-                    strftime('%Y-%m', InvoiceDate) AS year_month,
-                    ROUND(SUM(CASE WHEN Quantity > 0 THEN Quantity * UnitPrice ELSE 0 END), 2) AS revenue
-                FROM online_retail
-                WHERE InvoiceDate IS NOT NULL AND UnitPrice IS NOT NULL AND InvoiceNo NOT LIKE 'C%'
-                GROUP BY year_month
-            )
-            SELECT
-                year_month,
-                revenue,
-                LAG(revenue) OVER (ORDER BY year_month) AS previous_month_revenue,
-                ROUND(revenue - LAG(revenue) OVER (ORDER BY year_month), 2) AS revenue_change,
-                ROUND(100.0 * (revenue - LAG(revenue) OVER (ORDER BY year_month)) / 
-                      NULLIF(LAG(revenue) OVER (ORDER BY year_month), 0), 2) AS growth_rate_pct
-            FROM monthly_revenue
-            ORDER BY year_month;
-            """,
-            "=== Revenue Growth Rate (Month-over-Month) ==="
-        )
+        # 3.3 Revenue growth rate (derived from the monthly trend above)
+        revenue = monthly_trend["sales_revenue"]
+        previous = revenue.shift(1)
+        revenue_growth = pd.DataFrame({
+            "year_month": monthly_trend["year_month"],
+            "revenue": revenue,
+            "previous_month_revenue": previous,
+            "revenue_change": sql_round(revenue - previous),
+            "growth_rate_pct": sql_round(100.0 * (revenue - previous) / previous.replace(0, np.nan)),
+        })
+        print("\n=== Revenue Growth Rate (Month-over-Month) ===")
         print(revenue_growth)
         save_to_csv(revenue_growth, "revenue_growth_rate.csv")
 
@@ -242,15 +416,15 @@ def main():
             """
             SELECT
                 CustomerID,
-                ROUND(SUM(CASE WHEN Quantity > 0 THEN Quantity * UnitPrice ELSE 0 END), 2) AS customer_revenue,
-                COUNT(DISTINCT InvoiceNo) AS num_invoices,
-                COUNT(*) AS num_transactions,
-                MIN(InvoiceDate) AS first_purchase_date,
-                MAX(InvoiceDate) AS last_purchase_date,
-                ROUND(SUM(CASE WHEN Quantity > 0 THEN Quantity * UnitPrice ELSE 0 END) / 
-                      NULLIF(COUNT(DISTINCT InvoiceNo), 0), 2) AS avg_order_value
-            FROM online_retail
-            WHERE CustomerID IS NOT NULL AND UnitPrice IS NOT NULL AND InvoiceNo NOT LIKE 'C%'
+                ROUND(SUM(invoice_revenue), 2) AS customer_revenue,
+                COUNT(*) AS num_invoices,
+                SUM(line_count) AS num_transactions,
+                MIN(first_date) AS first_purchase_date,
+                MAX(last_date) AS last_purchase_date,
+                ROUND(ROUND(SUM(invoice_revenue), 2) /
+                      NULLIF(COUNT(*), 0), 2) AS avg_order_value
+            FROM invoice_summary
+            WHERE CustomerID IS NOT NULL
             GROUP BY CustomerID
             ORDER BY customer_revenue DESC
             LIMIT 20;
@@ -261,35 +435,27 @@ def main():
         save_to_csv(top_customers, "top_customers.csv")
 
         # 4.2 Customer purchase frequency distribution
-        customer_frequency = run_query(
+        customer_invoices = run_query(
             conn,
             """
             SELECT
-                CASE
-                    WHEN invoice_count = 1 THEN '1 purchase'
-                    WHEN invoice_count BETWEEN 2 AND 5 THEN '2-5 purchases'
-                    WHEN invoice_count BETWEEN 6 AND 10 THEN '6-10 purchases'
-                    WHEN invoice_count BETWEEN 11 AND 20 THEN '11-20 purchases'
-                    WHEN invoice_count BETWEEN 21 AND 50 THEN '21-50 purchases'
-                    ELSE '50+ purchases'
-                END AS purchase_frequency_category,
-                COUNT(*) AS num_customers,
-                ROUND(100.0 * COUNT(*) / (SELECT COUNT(DISTINCT CustomerID) 
-                                          FROM online_retail 
-                                          WHERE CustomerID IS NOT NULL), 2) AS percentage
-            FROM (
-                SELECT
-                    CustomerID,
-                    COUNT(DISTINCT InvoiceNo) AS invoice_count
-                FROM online_retail
-                WHERE CustomerID IS NOT NULL AND InvoiceNo NOT LIKE 'C%'
-                GROUP BY CustomerID
-            ) AS customer_freq
-            GROUP BY purchase_frequency_category
-            ORDER BY MIN(invoice_count);
+                CustomerID,
+                COUNT(DISTINCT CASE WHEN is_cancel = 0 THEN InvoiceNo END) AS invoice_count
+            FROM online_retail
+            WHERE CustomerID IS NOT NULL
+            GROUP BY CustomerID;
             """,
             "=== Customer Purchase Frequency Distribution ==="
         )
+        # Customers with only cancelled invoices count towards the total but no bucket
+        invoice_counts = customer_invoices["invoice_count"].to_numpy()
+        customer_frequency = bucket_distribution(
+            invoice_counts[invoice_counts > 0],
+            PURCHASE_FREQUENCY_LABELS,
+            "purchase_frequency_category",
+            "num_customers",
+            total=len(invoice_counts),
+        )
         print(customer_frequency)
         save_to_csv(customer_frequency, "customer_frequency_distribution.csv")
 
@@ -299,15 +465,15 @@ def main():
             """
             SELECT
                 CustomerID,
-                ROUND(SUM(CASE WHEN Quantity > 0 THEN Quantity * UnitPrice ELSE 0 END), 2) AS total_revenue,
+                ROUND(SUM(sales_amt), 2) AS total_revenue,
                 COUNT(DISTINCT InvoiceNo) AS total_orders,
-                COUNT(DISTINCT strftime('%Y-%m', InvoiceDate)) AS active_months,
+                COUNT(DISTINCT year_month) AS active_months,
                 MIN(InvoiceDate) AS first_purchase,
                 MAX(InvoiceDate) AS last_purchase,
-                ROUND(SUM(CASE WHEN Quantity > 0 THEN Quantity * UnitPrice ELSE 0 END) / 
-                      NULLIF(COUNT(DISTINCT strftime('%Y-%m', InvoiceDate)), 0), 2) AS revenue_per_month
-            FROM online_retail
-            WHERE CustomerID IS NOT NULL AND UnitPrice IS NOT NULL AND InvoiceNo NOT LIKE 'C%'
+                ROUND(SUM(sales_amt) / 
+                      NULLIF(COUNT(DISTINCT year_month), 0), 2) AS revenue_per_month
+            FROM base
+            WHERE CustomerID IS NOT NULL AND is_cancel = 0
             GROUP BY CustomerID
             HAVING total_orders >= 2
             ORDER BY total_revenue DESC
@@ -326,148 +492,28 @@ def main():
         print("=" * 70)
 
         # 5.1 RFM Segmentation
-        rfm_segments = run_query(
+        customer_metrics = run_query(
             conn,
             """
-            WITH customer_metrics AS (
-                SELECT
-                    CustomerID,
-                    MAX(InvoiceDate) AS last_purchase_date,
-                    COUNT(DISTINCT InvoiceNo) AS frequency,
-                    ROUND(SUM(CASE WHEN Quantity > 0 THEN Quantity * UnitPrice ELSE 0 END), 2) AS monetary_value,
-                    JULIANDAY('now') - JULIANDAY(MAX(InvoiceDate)) AS days_since_last_purchase
-                FROM online_retail
-                WHERE CustomerID IS NOT NULL AND UnitPrice IS NOT NULL AND InvoiceNo NOT LIKE 'C%' AND Quantity > 0
-                GROUP BY CustomerID
-            ),
-            rfm_scores AS (
-                SELECT
-                    CustomerID,
-                    last_purchase_date,
-                    frequency,
-                    monetary_value,
-                    days_since_last_purchase,
-                    CASE 
-                        WHEN days_since_last_purchase <= 30 THEN 5
-                        WHEN days_since_last_purchase <= 60 THEN 4
-                        WHEN days_since_last_purchase <= 90 THEN 3
-                        WHEN days_since_last_purchase <= 180 THEN 2
-                        ELSE 1
-                    END AS recency_score,
-                    CASE 
-                        WHEN frequency >= 50 THEN 5
-                        WHEN frequency >= 20 THEN 4
-                        WHEN frequency >= 10 THEN 3
-                        WHEN frequency >= 5 THEN 2
-                        ELSE 1
-                    END AS frequency_score,
-                    CASE 
-                        WHEN monetary_value >= 5000 THEN 5
-                        WHEN monetary_value >= 2000 THEN 4
-                        WHEN monetary_value >= 1000 THEN 3
-                        WHEN monetary_value >= 500 THEN 2
-                        ELSE 1
-                    END AS monetary_score
-                FROM customer_metrics
-            )
             SELECT
                 CustomerID,
-                last_purchase_date,
-                days_since_last_purchase,
-                frequency,
-                monetary_value,
-                recency_score,
-                frequency_score,
-                monetary_score,
-                (recency_score + frequency_score + monetary_score) AS rfm_score,
-                CASE
-                    WHEN recency_score >= 4 AND frequency_score >= 4 AND monetary_score >= 4 THEN 'Champions'
-                    WHEN recency_score >= 3 AND frequency_score >= 4 AND monetary_score >= 3 THEN 'Loyal Customers'
-                    WHEN recency_score >= 4 AND frequency_score <= 2 THEN 'Potential Loyalists'
-                    WHEN recency_score >= 3 AND frequency_score <= 2 AND monetary_score >= 3 THEN 'At Risk'
-                    WHEN recency_score <= 2 AND frequency_score >= 3 THEN 'Cannot Lose Them'
-                    WHEN recency_score <= 2 AND frequency_score <= 2 AND monetary_score >= 3 THEN 'Hibernating'
-                    WHEN recency_score <= 2 THEN 'Lost'
-                    ELSE 'Need Attention'
-                END AS customer_segment
-            FROM rfm_scores
-            ORDER BY rfm_score DESC, monetary_value DESC;
+                MAX(last_date) AS last_purchase_date,
+                JULIANDAY('now') - JULIANDAY(MAX(last_date)) AS days_since_last_purchase,
+                COUNT(*) AS frequency,
+                ROUND(SUM(invoice_revenue), 2) AS monetary_value
+            FROM invoice_summary
+            WHERE CustomerID IS NOT NULL AND invoice_qty > 0
+            GROUP BY CustomerID;
             """,
             "=== RFM Customer Segmentation ==="
         )
+        rfm_segments = score_rfm(customer_metrics)
         print(rfm_segments.head(20))
         save_to_csv(rfm_segments, "rfm_segments.csv")
 
         # 5.2 RFM Segment Summary
-        rfm_summary = run_query(
-            conn,
-            """
-            WITH customer_metrics AS (
-                SELECT
-                    CustomerID,
-                    COUNT(DISTINCT InvoiceNo) AS frequency,
-                    ROUND(SUM(CASE WHEN Quantity > 0 THEN Quantity * UnitPrice ELSE 0 END), 2) AS monetary_value,
-                    JULIANDAY('now') - JULIANDAY(MAX(InvoiceDate)) AS days_since_last_purchase
-                FROM online_retail
-                WHERE CustomerID IS NOT NULL AND UnitPrice IS NOT NULL AND InvoiceNo NOT LIKE 'C%' AND Quantity > 0
-                GROUP BY CustomerID
-            ),
-            rfm_scores AS (
-                SELECT
-                    CustomerID,
-                    frequency,
-                    monetary_value,
-                    CASE 
-                        WHEN days_since_last_purchase <= 30 THEN 5
-                        WHEN days_since_last_purchase <= 60 THEN 4
-                        WHEN days_since_last_purchase <= 90 THEN 3
-                        WHEN days_since_last_purchase <= 180 THEN 2
-                        ELSE 1
-                    END AS recency_score,
-                    CASE 
-                        WHEN frequency >= 50 THEN 5
-                        WHEN frequency >= 20 THEN 4
-                        WHEN frequency >= 10 THEN 3
-                        WHEN frequency >= 5 THEN 2
-                        ELSE 1
-                    END AS frequency_score,
-                    CASE 
-                        WHEN monetary_value >= 5000 THEN 5
-                        WHEN monetary_value >= 2000 THEN 4
-                        WHEN monetary_value >= 1000 THEN 3
-                        WHEN monetary_value >= 500 THEN 2
-                        ELSE 1
-                    END AS monetary_score
-                FROM customer_metrics
-            ),
-            segmented AS (
-                SELECT
-                    CASE
-                        WHEN recency_score >= 4 AND frequency_score >= 4 AND monetary_score >= 4 THEN 'Champions'
-                        WHEN recency_score >= 3 AND frequency_score >= 4 AND monetary_score >= 3 THEN 'Loyal Customers'
-                        WHEN recency_score >= 4 AND frequency_score <= 2 THEN 'Potential Loyalists'
-                        WHEN recency_score >= 3 AND frequency_score <= 2 AND monetary_score >= 3 THEN 'At Risk'
-                        WHEN recency_score <= 2 AND frequency_score >= 3 THEN 'Cannot Lose Them'
-                        WHEN recency_score <= 2 AND frequency_score <= 2 AND monetary_score >= 3 THEN 'Hibernating'
-                        WHEN recency_score <= 2 THEN 'Lost'
-                        ELSE 'Need Attention'
-                    END AS customer_segment,
-                    CustomerID,
-                    monetary_value
-                FROM rfm_scores
-            )
-            SELECT
-                customer_segment,
-                COUNT(*) AS num_customers,
-                ROUND(100.0 * COUNT(*) / (SELECT COUNT(*) FROM segmented), 2) AS percentage,
-                ROUND(SUM(monetary_value), 2) AS total_revenue,
-                ROUND(AVG(monetary_value), 2) AS avg_customer_value
-            FROM segmented
-            GROUP BY customer_segment
-            ORDER BY total_revenue DESC;
-            """,
-            "=== RFM Segment Summary Statistics ==="
-        )
+        rfm_summary = summarize_rfm(rfm_segments)
+        print("\n=== RFM Segment Summary Statistics ===")
         print(rfm_summary)
         save_to_csv(rfm_summary, "rfm_segment_summary.csv")
 
@@ -484,15 +530,13 @@ def main():
             """
             SELECT
                 StockCode,
-                COALESCE(Description, 'No Description') AS Description,
-                ROUND(SUM(CASE WHEN Quantity > 0 THEN Quantity * UnitPrice ELSE 0 END), 2) AS product_revenue,
-                SUM(CASE WHEN Quantity > 0 THEN Quantity ELSE 0 END) AS total_quantity_sold,
-                COUNT(DISTINCT InvoiceNo) AS times_purchased,
-                COUNT(DISTINCT CustomerID) AS unique_customers,
-                ROUND(AVG(UnitPrice), 2) AS avg_unit_price
-            FROM online_retail
-            WHERE UnitPrice IS NOT NULL AND InvoiceNo NOT LIKE 'C%'
-            GROUP BY StockCode, Description
+                Description,
+                product_revenue,
+                total_quantity_sold,
+                times_purchased,
+                unique_customers,
+                avg_unit_price
+            FROM product_summary
             ORDER BY product_revenue DESC
             LIMIT 30;
             """,
@@ -507,14 +551,12 @@ def main():
             """
             SELECT
                 StockCode,
-                COALESCE(Description, 'No Description') AS Description,
-                SUM(CASE WHEN Quantity > 0 THEN Quantity ELSE 0 END) AS total_quantity_sold,
-                ROUND(SUM(CASE WHEN Quantity > 0 THEN Quantity * UnitPrice ELSE 0 END), 2) AS product_revenue,
-                COUNT(DISTINCT InvoiceNo) AS times_purchased,
-                COUNT(DISTINCT CustomerID) AS unique_customers
-            FROM online_retail
-            WHERE UnitPrice IS NOT NULL AND InvoiceNo NOT LIKE 'C%'
-            GROUP BY StockCode, Description
+                Description,
+                total_quantity_sold,
+                product_revenue,
+                times_purchased,
+                unique_customers
+            FROM product_summary
             ORDER BY total_quantity_sold DESC
             LIMIT 30;
             """,
@@ -529,16 +571,13 @@ def main():
             """
             SELECT
                 StockCode,
-                COALESCE(Description, 'No Description') AS Description,
-                SUM(CASE WHEN Quantity > 0 THEN Quantity ELSE 0 END) AS total_sold,
-                SUM(CASE WHEN Quantity < 0 THEN ABS(Quantity) ELSE 0 END) AS total_returned,
-                ROUND(100.0 * SUM(CASE WHEN Quantity < 0 THEN ABS(Quantity) ELSE 0 END) / 
-                      NULLIF(SUM(CASE WHEN Quantity > 0 THEN Quantity ELSE 0 END) + 
-                             SUM(CASE WHEN Quantity < 0 THEN ABS(Quantity) ELSE 0 END), 0), 2) AS return_rate_pct
-            FROM online_retail
-            WHERE UnitPrice IS NOT NULL AND InvoiceNo NOT LIKE 'C%'
-            GROUP BY StockCode, Description
-            HAVING total_sold > 0
+                Description,
+                total_quantity_sold AS total_sold,
+                total_returned,
+                ROUND(100.0 * total_returned / 
+                      NULLIF(total_quantity_sold + total_returned, 0), 2) AS return_rate_pct
+            FROM product_summary
+            WHERE total_quantity_sold > 0
             ORDER BY return_rate_pct DESC
             LIMIT 30;
             """,
@@ -559,12 +598,12 @@ def main():
             conn,
             """
             SELECT
-                CAST(strftime('%H', InvoiceDate) AS INTEGER) AS hour_of_day,
+                hour_of_day,
                 COUNT(DISTINCT InvoiceNo) AS num_invoices,
                 COUNT(*) AS num_transactions,
-                ROUND(SUM(CASE WHEN Quantity > 0 THEN Quantity * UnitPrice ELSE 0 END), 2) AS revenue
-            FROM online_retail
-            WHERE InvoiceDate IS NOT NULL AND UnitPrice IS NOT NULL AND InvoiceNo NOT LIKE 'C%' AND Quantity > 0
+                ROUND(SUM(sales_amt), 2) AS revenue
+            FROM base
+            WHERE InvoiceDate IS NOT NULL AND is_cancel = 0 AND Quantity > 0
             GROUP BY hour_of_day
             ORDER BY hour_of_day;
             """,
@@ -578,7 +617,7 @@ def main():
             conn,
             """
             SELECT
-                CASE CAST(strftime('%w', InvoiceDate) AS INTEGER)
+                CASE weekday
                     WHEN 0 THEN 'Sunday'
                     WHEN 1 THEN 'Monday'
                     WHEN 2 THEN 'Tuesday'
@@ -588,9 +627,9 @@ def main():
                     WHEN 6 THEN 'Saturday'
                 END AS day_of_week,
                 COUNT(DISTINCT InvoiceNo) AS num_invoices,
-                ROUND(SUM(CASE WHEN Quantity > 0 THEN Quantity * UnitPrice ELSE 0 END), 2) AS revenue
-            FROM online_retail
-            WHERE InvoiceDate IS NOT NULL AND UnitPrice IS NOT NULL AND InvoiceNo NOT LIKE 'C%' AND Quantity > 0
+                ROUND(SUM(sales_amt), 2) AS revenue
+            FROM base
+            WHERE InvoiceDate IS NOT NULL AND is_cancel = 0 AND Quantity > 0
             GROUP BY day_of_week
             ORDER BY revenue DESC;
             """,
@@ -610,19 +649,35 @@ def main():
         country_analysis = run_query(
             conn,
             """
+            WITH country_invoices AS (
+                SELECT
+                    Country,
+                    COUNT(DISTINCT CustomerID) AS num_customers,
+                    COUNT(*) AS num_invoices,
+                    SUM(invoice_revenue) AS revenue
+                FROM invoice_summary
+                GROUP BY Country
+            ),
+            country_products AS (
+                SELECT
+                    Country,
+                    COUNT(DISTINCT StockCode) AS num_products
+                FROM base
+                WHERE is_cancel = 0
+                GROUP BY Country
+            )
             SELECT
-                Country,
-                COUNT(DISTINCT CustomerID) AS num_customers,
-                COUNT(DISTINCT InvoiceNo) AS num_invoices,
-                COUNT(DISTINCT StockCode) AS num_products,
-                ROUND(SUM(CASE WHEN Quantity > 0 THEN Quantity * UnitPrice ELSE 0 END), 2) AS sales_revenue,
-                ROUND(SUM(CASE WHEN Quantity > 0 THEN Quantity * UnitPrice ELSE 0 END) / 
-                      NULLIF(COUNT(DISTINCT InvoiceNo), 0), 2) AS avg_order_value,
-                ROUND(SUM(CASE WHEN Quantity > 0 THEN Quantity * UnitPrice ELSE 0 END) / 
-                      NULLIF(COUNT(DISTINCT CustomerID), 0), 2) AS revenue_per_customer
-            FROM online_retail
-            WHERE UnitPrice IS NOT NULL AND InvoiceNo NOT LIKE 'C%'
-            GROUP BY Country
+                ci.Country,
+                ci.num_customers,
+                ci.num_invoices,
+                cp.num_products,
+                ROUND(ci.revenue, 2) AS sales_revenue,
+                ROUND(ci.revenue / 
+                      NULLIF(ci.num_invoices, 0), 2) AS avg_order_value,
+                ROUND(ci.revenue / 
+                      NULLIF(ci.num_customers, 0), 2) AS revenue_per_customer
+            FROM country_invoices ci
+            JOIN country_products cp ON cp.Country IS ci.Country
             ORDER BY sales_revenue DESC;
             """,
             "=== Detailed Country Analysis ==="
@@ -641,22 +696,14 @@ def main():
         invoice_stats = run_query(
             conn,
             """
-            WITH invoice_stats AS (
-                SELECT
-                    InvoiceNo,
-                    SUM(CASE WHEN Quantity > 0 THEN Quantity * UnitPrice ELSE 0 END) AS invoice_revenue,
-                    SUM(CASE WHEN Quantity > 0 THEN Quantity ELSE 0 END) AS invoice_qty
-                FROM online_retail
-                WHERE UnitPrice IS NOT NULL AND InvoiceNo NOT LIKE 'C%' AND Quantity > 0
-                GROUP BY InvoiceNo
-            )
             SELECT
                 COUNT(*) AS total_invoices,
                 ROUND(AVG(invoice_revenue), 2) AS avg_order_value,
                 ROUND(AVG(invoice_qty), 2) AS avg_items_per_invoice,
                 ROUND(MAX(invoice_revenue), 2) AS max_order_value,
                 ROUND(MIN(invoice_revenue), 2) AS min_order_value
-            FROM invoice_stats;
+            FROM invoice_summary
+            WHERE invoice_qty > 0;
             """,
             "=== Invoice-Level Statistics ==="
         )
@@ -664,35 +711,27 @@ def main():
         save_to_csv(invoice_stats, "invoice_averages.csv")
 
         # 9.2 Basket size distribution
-        basket_distribution = run_query(
+        invoice_items = run_query(
             conn,
             """
             SELECT
-                CASE
-                    WHEN items_per_invoice = 1 THEN '1 item'
-                    WHEN items_per_invoice BETWEEN 2 AND 5 THEN '2-5 items'
-                    WHEN items_per_invoice BETWEEN 6 AND 10 THEN '6-10 items'
-                    WHEN items_per_invoice BETWEEN 11 AND 20 THEN '11-20 items'
-                    WHEN items_per_invoice BETWEEN 21 AND 50 THEN '21-50 items'
-                    ELSE '50+ items'
-                END AS basket_size_category,
-                COUNT(*) AS num_invoices,
-                ROUND(100.0 * COUNT(*) / (SELECT COUNT(DISTINCT InvoiceNo) 
-                                          FROM online_retail 
-                                          WHERE InvoiceNo NOT LIKE 'C%'), 2) AS percentage
-            FROM (
-                SELECT
-                    InvoiceNo,
-                    SUM(CASE WHEN Quantity > 0 THEN Quantity ELSE 0 END) AS items_per_invoice
-                FROM online_retail
-                WHERE InvoiceNo NOT LIKE 'C%' AND Quantity > 0
-                GROUP BY InvoiceNo
-            ) AS invoice_items
-            GROUP BY basket_size_category
-            ORDER BY MIN(items_per_invoice);
+                InvoiceNo,
+                SUM(CASE WHEN Quantity > 0 THEN Quantity END) AS items_per_invoice
+            FROM online_retail
+            WHERE is_cancel = 0
+            GROUP BY InvoiceNo;
             """,
             "=== Basket Size Distribution ==="
         )
+        # Invoices with no positive quantity count towards the total but no bucket
+        items_per_invoice = invoice_items["items_per_invoice"]
+        basket_distribution = bucket_distribution(
+            items_per_invoice.dropna().to_numpy(),
+            BASKET_SIZE_LABELS,
+            "basket_size_category",
+            "num_invoices",
+            total=len(items_per_invoice),
+        )
         print(basket_distribution)
         save_to_csv(basket_distribution, "basket_size_distribution.csv")
 
@@ -704,29 +743,29 @@ def main():
         print("=" * 70)
 
         # 10.1 Customer cohorts
+        create_sales_table(conn)
         customer_cohorts = run_query(
             conn,
             """
             WITH first_purchase AS (
                 SELECT
                     CustomerID,
-                    MIN(strftime('%Y-%m', InvoiceDate)) AS first_purchase_date,
+                    MIN(order_month) AS first_purchase_date,
                     MIN(InvoiceDate) AS first_purchase_datetime
-                FROM online_retail
-                WHERE CustomerID IS NOT NULL AND InvoiceNo NOT LIKE 'C%' AND Quantity > 0
+                FROM sales
                 GROUP BY CustomerID
             ),
             cohorts AS (
                 SELECT
                     fp.first_purchase_date AS cohort_month,
-                    strftime('%Y-%m', o.InvoiceDate) AS order_month,
-                    COUNT(DISTINCT o.CustomerID) AS customers,
-                    COUNT(DISTINCT o.InvoiceNo) AS orders,
-                    ROUND(SUM(CASE WHEN o.Quantity > 0 THEN o.Quantity * o.UnitPrice ELSE 0 END), 2) AS revenue
-                FROM online_retail o
-                JOIN first_purchase fp ON o.CustomerID = fp.CustomerID
-                WHERE o.UnitPrice IS NOT NULL AND o.InvoiceNo NOT LIKE 'C%' AND o.Quantity > 0
-                GROUP BY fp.first_purchase_date, order_month
+                    s.order_month,
+                    COUNT(DISTINCT s.CustomerID) AS customers,
+                    COUNT(DISTINCT s.InvoiceNo) AS orders,
+                    ROUND(SUM(s.line_revenue), 2) AS revenue
+                FROM sales s
+                JOIN first_purchase fp ON s.CustomerID = fp.CustomerID
+                WHERE s.UnitPrice IS NOT NULL
+                GROUP BY fp.first_purchase_date, s.order_month
             )
             SELECT 
                 cohort_month,
@@ -753,19 +792,29 @@ def main():
         business_kpis = run_query(
             conn,
             """
+            WITH invoice_totals AS (
+                SELECT
+                    COUNT(*) AS num_invoices,
+                    COUNT(DISTINCT CustomerID) AS num_customers,
+                    COUNT(DISTINCT Country) AS num_countries,
+                    SUM(invoice_revenue) AS revenue,
+                    1.0 * SUM(invoice_qty) / SUM(line_count) AS items_per_line
+                FROM invoice_summary
+            ),
+            product_totals AS (
+                SELECT COUNT(DISTINCT StockCode) AS num_products
+                FROM product_summary
+            )
             SELECT
-                COUNT(DISTINCT InvoiceNo) AS total_invoices,
-                COUNT(DISTINCT CustomerID) AS total_customers,
-                COUNT(DISTINCT StockCode) AS total_products,
-                COUNT(DISTINCT Country) AS total_countries,
-                ROUND(SUM(CASE WHEN Quantity > 0 THEN Quantity * UnitPrice ELSE 0 END), 2) AS total_sales_revenue,
-                ROUND(SUM(CASE WHEN Quantity > 0 THEN Quantity * UnitPrice ELSE 0 END) / 
-                      NULLIF(COUNT(DISTINCT InvoiceNo), 0), 2) AS avg_order_value,
-                ROUND(SUM(CASE WHEN Quantity > 0 THEN Quantity * UnitPrice ELSE 0 END) / 
-                      NULLIF(COUNT(DISTINCT CustomerID), 0), 2) AS avg_customer_value,
-                ROUND(AVG(CASE WHEN Quantity > 0 THEN Quantity ELSE 0 END), 2) AS avg_items_per_transaction
-            FROM online_retail
-            WHERE UnitPrice IS NOT NULL AND InvoiceNo NOT LIKE 'C%';
+                num_invoices AS total_invoices,
+                num_customers AS total_customers,
+                num_products AS total_products,
+                num_countries AS total_countries,
+                ROUND(revenue, 2) AS total_sales_revenue,
+                ROUND(revenue / NULLIF(num_invoices, 0), 2) AS avg_order_value,
+                ROUND(revenue / NULLIF(num_customers, 0), 2) AS avg_customer_value,
+                ROUND(items_per_line, 2) AS avg_items_per_transaction
+            FROM invoice_totals, product_totals;
             """,
             "=== Overall Business KPIs ==="
         )
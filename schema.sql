@@ -10,18 +10,9 @@ CREATE TABLE online_retail (
     InvoiceDate  TEXT,       -- stored as ISO-8601 string (YYYY-MM-DD HH:MM:SS)
     UnitPrice    REAL,
     CustomerID   TEXT,
-    Country      TEXT
+    Country      TEXT,
+    -- 1 for cancelled invoices (InvoiceNo starts with 'C'), computed once on insert
+    is_cancel    INTEGER GENERATED ALWAYS AS (InvoiceNo LIKE 'C%') STORED
 );
 
--- Optional index to speed up common queries
-CREATE INDEX IF NOT EXISTS idx_online_retail_invoicedate
-    ON online_retail (InvoiceDate);
-
-CREATE INDEX IF NOT EXISTS idx_online_retail_customer
-    ON online_retail (CustomerID);
-
-CREATE INDEX IF NOT EXISTS idx_online_retail_country
-    ON online_retail (Country);
-
-
-
+-- Indexes are defined in indexes.sql and created after the data is loaded